@@ -1,22 +1,31 @@
 #!/usr/bin/env python3
 
 import configparser
-import glob
 import os
 import shutil
 import subprocess
 import sys
 from datetime import datetime
 
-from PIL import Image, ImageDraw
-from PyQt5.QtCore import Qt, QTimer
-from PyQt5.QtGui import QPainter, QImage, QPixmap, QPen, QColor
+from PIL import Image
+from PyQt5.QtCore import (
+    Qt, QTimer, QPoint, QPointF, QRect, QRectF, QRunnable,
+    QThreadPool, pyqtSignal
+)
+from PyQt5.QtGui import (
+    QPainter, QPainterPath, QImage, QPixmap, QPen, QColor, QBrush,
+    QPolygonF, QTransform
+)
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QPushButton, QLabel
 )
 
 MAX_NOTES = 50
+FRAME_INTERVAL = 16  # ms, caps overlay repaints at ~60 Hz
+SAVE_DELAY = 1000  # ms of inactivity before a note is written
+WORKSPACE_POLL = 200  # ms between checks for our window in `wmctrl -l`
+WORKSPACE_POLL_LIMIT = 50  # give up waiting after ~10 s
 CONFIG_DIR = os.path.join(os.environ.get("HOME", ""), ".config", "handnotes")
 DEFAULTS = {
     "ratio": "3", "x": "999", "y": "999", "width": "600", "height": "400",
@@ -24,6 +33,9 @@ DEFAULTS = {
     "button_fg": "#fff", "line_color": "black", "line_width": "3",
     "workspace": "1", "time_res": "50"
 }
+INT_KEYS = {
+    "ratio", "x", "y", "width", "height", "line_width", "workspace", "time_res"
+}
 
 
 class ListManipulator:
@@ -31,10 +43,17 @@ class ListManipulator:
         self._list, self._index, self.maxsize = [], -1, maxsize
 
     def add(self, item):
+        # Returns the item pushed out by maxsize, if any.
         self._list.append(item)
+        dropped = None
         if len(self._list) > self.maxsize:
-            self._list.pop(0)
+            dropped = self._list.pop(0)
         self._index = len(self._list) - 1
+        return dropped
+
+    def last(self):
+        if self._list:
+            return self._list[-1]
 
     def previous(self):
         if self._index > 0:
@@ -47,96 +66,228 @@ class ListManipulator:
             return self._list[self._index]
 
 
+class SaveTask(QRunnable):
+    def __init__(self, img, path, saved):
+        super().__init__()
+        self.img, self.path, self.saved = img, path, saved
+
+    def run(self):
+        # Write under a temporary name so a note being navigated to is
+        # never read half-written.
+        tmp = self.path + ".part"
+        try:
+            self.img.save(tmp, format="PNG", compress_level=1, optimize=False)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"Error saving: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        # Queued to the GUI thread, which owns the note history.
+        self.saved.emit(self.path)
+
+
 class Canvas(QLabel):
     def __init__(self, parent, cfg):
         super().__init__(parent)
         self.parent_app = parent
         self.cfg = cfg
         self.canvas_w, self.canvas_h = cfg["width"], cfg["height"]
-        self.image = Image.new(
-            "RGB",
-            (self.canvas_w * cfg["ratio"], self.canvas_h * cfg["ratio"]),
-            cfg["bg_color"]
-        )
-        self.draw = ImageDraw.Draw(self.image, "RGBA")
+        self._hires = self._hires_bits = self._hires_view = None
+        self._hires_painter = self._live_painter = None
         self.last_x = self.last_y = None
         self.erasing = False
         self.setFixedSize(self.canvas_w, self.canvas_h)
-        self.setMouseTracking(True)
-        self._base_pixmap = None
-        self._pending_lines = []
+        # Strokes are drawn straight onto the displayed pixmap and only the
+        # region they cover is re-synced from the high-res image on flush.
+        self._live_pixmap = QPixmap(self.canvas_w, self.canvas_h)
+        # Each pending stroke is a polyline; _stroke is the one that new
+        # samples extend, None until the next move starts a fresh one.
+        self._pending_strokes = []
+        self._stroke = None
+        self._pending_erases = []
+        self._drawn_strokes = self._drawn_points = self._drawn_erases = 0
         self._update_timer = QTimer()
         self._update_timer.setInterval(cfg["time_res"])
-        self._update_timer.timeout.connect(self._flush_and_continue)
-        self._overlay_pen = self._create_overlay_pen()
-        self._rebuild_base_pixmap()
+        self._update_timer.timeout.connect(self._periodic_flush)
+        self._overlay_dirty = False
+        self._overlay_timer = QTimer()
+        self._overlay_timer.setInterval(FRAME_INTERVAL)
+        self._overlay_timer.timeout.connect(self._redraw_if_dirty)
+        self._overlay_pen = self._create_pen(
+            max(1, cfg["line_width"] // cfg["ratio"])
+        )
+        self._line_pen = self._create_pen(cfg["line_width"])
+        r = cfg["line_width"] * 10
+        self._erase_stamp = self._create_erase_stamp(r)
+        self._overlay_erase_stamp = self._create_erase_stamp(r // cfg["ratio"])
+        self.clear_image()
 
-    def _create_overlay_pen(self):
+    def _create_pen(self, width):
         pen = QPen(QColor(self.cfg["line_color"]))
-        pen.setWidth(max(1, self.cfg["line_width"] // self.cfg["ratio"]))
+        pen.setWidth(width)
         pen.setCapStyle(Qt.RoundCap)
         pen.setJoinStyle(Qt.RoundJoin)
         return pen
 
-    def _rebuild_base_pixmap(self):
-        img = self.image.resize(
-            (self.canvas_w, self.canvas_h), resample=Image.BILINEAR
+    def _create_erase_stamp(self, r):
+        # A pre-rendered disk, blitted per sample instead of rasterizing
+        # a fresh ellipse every time.
+        size = 2 * r + 2
+        stamp = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+        stamp.fill(Qt.transparent)
+        painter = QPainter(stamp)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QBrush(QColor(self.cfg["bg_color"])))
+        painter.drawEllipse(QPointF(r + 1, r + 1), r, r)
+        painter.end()
+        return stamp
+
+    def _sync_live_pixmap(self, dirty=None):
+        if dirty is None:
+            pos = QPoint(0, 0)
+            patch = self._hires
+            if patch.size() != self._live_pixmap.size():
+                patch = patch.scaled(
+                    self.canvas_w, self.canvas_h,
+                    Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+                )
+        else:
+            pos, patch = self._scaled_patch(dirty)
+        self._get_live_painter().drawImage(pos, patch)
+        self._pending_strokes.clear()
+        self._stroke = None
+        self._pending_erases.clear()
+        self._drawn_strokes = self._drawn_points = self._drawn_erases = 0
+        self._overlay_dirty = False
+        self.update(QRect(pos, patch.size()))
+
+    def _scaled_patch(self, rect):
+        # Snap ``rect`` (high-res coordinates) outwards to whole screen
+        # pixels so the downscaled patch lands exactly on the preview.
+        r = self.cfg["ratio"]
+        rect = rect.toAlignedRect()
+        left, top = max(0, rect.left() // r), max(0, rect.top() // r)
+        right = min(self.canvas_w, -(-(rect.right() + 1) // r))
+        bottom = min(self.canvas_h, -(-(rect.bottom() + 1) // r))
+        w, h = right - left, bottom - top
+        patch = self._hires.copy(left * r, top * r, w * r, h * r)
+        if r == 1:
+            return QPoint(left, top), patch
+        return QPoint(left, top), patch.scaled(
+            w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation
         )
-        data = img.convert("RGBA").tobytes("raw", "RGBA")
-        qimg = QImage(data, self.canvas_w, self.canvas_h,
-                      QImage.Format_RGBA8888)
-        self._base_pixmap = QPixmap.fromImage(qimg)
-        self._pending_lines.clear()
-        self.setPixmap(self._base_pixmap)
 
     def _flush_to_image(self):
-        if not self._pending_lines:
+        if not (self._pending_strokes or self._pending_erases):
             return
         r = self.cfg["ratio"]
-        for x1, y1, x2, y2 in self._pending_lines:
-            self.draw.line(
-                [x1 * r, y1 * r, x2 * r, y2 * r],
-                fill=self.cfg["line_color"],
-                width=self.cfg["line_width"],
-                joint="curve"
-            )
-        self._rebuild_base_pixmap()
-
-    def _flush_and_continue(self):
-        self._flush_to_image()
-        self._sample_mouse_position()
+        painter = self._get_hires_painter()
+        dirty = QRectF()
+        if self._pending_strokes:
+            # One subpath per stroke, so the whole batch is rasterized, with
+            # proper joins, in a single call.
+            path = QPainterPath()
+            for stroke in self._pending_strokes:
+                path.addPolygon(stroke)
+            path = QTransform.fromScale(r, r).map(path)
+            painter.setPen(self._line_pen)
+            painter.setBrush(Qt.NoBrush)
+            painter.drawPath(path)
+            w = self.cfg["line_width"]
+            dirty = path.boundingRect().adjusted(-w, -w, w, w)
+        for x, y in self._pending_erases:
+            dirty = dirty.united(self._erase_at(painter, x * r, y * r))
+        # Leave room for the antialiased fringe of the overlay strokes.
+        self._sync_live_pixmap(dirty.adjusted(-2 * r, -2 * r, 2 * r, 2 * r))
+
+    def _get_hires_painter(self):
+        if self._hires_painter is None:
+            self._hires_painter = QPainter(self._hires)
+            self._hires_painter.setRenderHint(QPainter.Antialiasing)
+        return self._hires_painter
+
+    def _end_hires_painter(self):
+        if self._hires_painter is not None:
+            self._hires_painter.end()
+            self._hires_painter = None
+
+    def _get_live_painter(self):
+        # Configured once; the overlay never changes pen or brush, since
+        # erases are blitted from a stamp.
+        if self._live_painter is None:
+            self._live_painter = QPainter(self._live_pixmap)
+            self._live_painter.setPen(self._overlay_pen)
+            self._live_painter.setRenderHint(QPainter.Antialiasing)
+        return self._live_painter
+
+    def end_painting(self):
+        # Painters must be ended before their paint devices are destroyed.
+        self._end_hires_painter()
+        if self._live_painter is not None:
+            self._live_painter.end()
+            self._live_painter = None
+
+    def _periodic_flush(self):
+        # Erases are only previewed while the button is held; the
+        # high-res image is touched once, on release.
+        if not self.erasing:
+            self._flush_to_image()
 
-    def _sample_mouse_position(self):
-        pos = self.mapFromGlobal(self.cursor().pos())
-        x, y = pos.x(), pos.y()
+    def mouseMoveEvent(self, event):
+        # Without mouse tracking Qt only reports moves while a button is
+        # held; last_x is None once any button has been released.
+        if self.last_x is None:
+            return
+        x, y = event.x(), event.y()
         if not (0 <= x < self.canvas_w and 0 <= y < self.canvas_h):
             return
-        if self.last_x is not None:
-            if self.erasing:
-                self._erase_at(x * self.cfg["ratio"], y * self.cfg["ratio"])
-                self._rebuild_base_pixmap()
-            else:
-                self._pending_lines.append((self.last_x, self.last_y, x, y))
-                self._draw_overlay()
+        if self.erasing:
+            self._pending_erases.append((x, y))
+        else:
+            if self._stroke is None:
+                self._stroke = QPolygonF([QPointF(self.last_x, self.last_y)])
+                self._pending_strokes.append(self._stroke)
+            self._stroke.append(QPointF(x, y))
+        self._overlay_dirty = True
         self.last_x, self.last_y = x, y
 
-    def mouseMoveEvent(self, event):
-        pass
+    def _redraw_if_dirty(self):
+        if self._overlay_dirty:
+            self._overlay_dirty = False
+            self._draw_overlay()
 
     def _draw_overlay(self):
-        if self._base_pixmap is None:
-            return
-        pixmap = self._base_pixmap.copy()
-        painter = QPainter(pixmap)
-        painter.setPen(self._overlay_pen)
-        painter.setRenderHint(QPainter.Antialiasing)
-        for x1, y1, x2, y2 in self._pending_lines:
-            painter.drawLine(x1, y1, x2, y2)
+        painter = self._get_live_painter()
+        # Resume one point early so the new part joins what is on screen.
+        start = max(0, self._drawn_points - 1)
+        for stroke in self._pending_strokes[self._drawn_strokes:]:
+            if len(stroke) - start > 1:
+                painter.drawPolyline(stroke[start:])
+            start = 0
+        if self._pending_strokes:
+            self._drawn_strokes = len(self._pending_strokes) - 1
+            self._drawn_points = len(self._pending_strokes[-1])
+        r = self.cfg["line_width"] * 10 // self.cfg["ratio"]
+        for x, y in self._pending_erases[self._drawn_erases:]:
+            painter.drawImage(x - r - 1, y - r - 1, self._overlay_erase_stamp)
+        self._drawn_erases = len(self._pending_erases)
+        self.update()
+
+    def paintEvent(self, event):
+        # The live pixmap is painted directly rather than handed to
+        # setPixmap(), whose shared copy would make every QPainter on it
+        # detach into a full-size copy.
+        painter = QPainter(self)
+        painter.drawPixmap(event.rect(), self._live_pixmap, event.rect())
         painter.end()
-        self.setPixmap(pixmap)
 
     def mouseReleaseEvent(self, event):
         self._update_timer.stop()
+        self._overlay_timer.stop()
         self._flush_to_image()
         self.last_x = self.last_y = None
         if event.button() == Qt.RightButton:
@@ -144,33 +295,79 @@ class Canvas(QLabel):
         self.parent_app.save_note()
 
     def mousePressEvent(self, event):
+        self.parent_app.cancel_save()
         if event.button() == Qt.RightButton:
             self.erasing = True
         self.last_x, self.last_y = event.x(), event.y()
+        self._stroke = None
         if not self._update_timer.isActive():
             self._update_timer.start()
+            self._overlay_timer.start()
 
-    def _erase_at(self, x, y):
+    def _erase_at(self, painter, x, y):
         r = self.cfg["line_width"] * 10
-        self.draw.ellipse(
-            [(x - r, y - r), (x + r, y + r)], fill=self.cfg["bg_color"]
+        painter.drawImage(x - r - 1, y - r - 1, self._erase_stamp)
+        return QRectF(x - r - 1, y - r - 1, 2 * r + 2, 2 * r + 2)
+
+    def _ensure_buffer(self, size):
+        # The QImage owns the pixels; the PIL view used to load and save
+        # notes maps the same memory through bits(). RGBX has the same byte
+        # layout on both sides, so neither view copies the pixels. Wrapping
+        # Python-owned memory instead does not work: PyQt5 hands it to Qt
+        # as read-only, and the first paint detaches into a private copy.
+        if self._hires_view is not None and self._hires_view.size == size:
+            return
+        self._end_hires_painter()
+        self._hires = QImage(*size, QImage.Format_RGBX8888)
+        ptr = self._hires.bits()
+        ptr.setsize(self._hires.byteCount())
+        self._hires_bits = memoryview(ptr)
+        self._hires_view = Image.frombuffer(
+            "RGBX", size, ptr, "raw", "RGBX", self._hires.bytesPerLine(), 1
         )
 
     def set_image(self, img):
-        self.image = img
-        self.draw = ImageDraw.Draw(self.image, "RGBA")
-        self._rebuild_base_pixmap()
+        self._ensure_buffer(img.size)
+        # Saved notes are already RGB; convert() would only copy them.
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        self._hires_bits[:] = img.tobytes("raw", "RGBX")
+        self._sync_live_pixmap()
+
+    def clear_image(self):
+        r = self.cfg["ratio"]
+        self._ensure_buffer((self.canvas_w * r, self.canvas_h * r))
+        self._hires.fill(QColor(self.cfg["bg_color"]))
+        self._sync_live_pixmap()
+
+    def to_image(self):
+        return self._hires_view.convert("RGB")
 
 
 class NoteApp(QMainWindow):
+    note_saved = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
         self.cfg = self._load_config()
+        self._save_timer = QTimer(self)
+        self._save_timer.setSingleShot(True)
+        self._save_timer.timeout.connect(self._do_save)
+        # A single worker keeps writes (and overwrites of the same second's
+        # file) in order.
+        self._save_pool = QThreadPool(self)
+        self._save_pool.setMaxThreadCount(1)
+        self.note_saved.connect(self._on_note_saved)
         self._setup_window()
         self.notes = ListManipulator(maxsize=MAX_NOTES)
         self._initialize_notes()
         self._load_last_note()
-        QTimer.singleShot(2000, self._set_workspace)
+        if shutil.which("wmctrl"):
+            self._workspace_polls = 0
+            self._workspace_timer = QTimer(self)
+            self._workspace_timer.setInterval(WORKSPACE_POLL)
+            self._workspace_timer.timeout.connect(self._set_workspace)
+            self._workspace_timer.start()
 
     def _load_config(self):
         os.makedirs(CONFIG_DIR, exist_ok=True)
@@ -184,21 +381,10 @@ class NoteApp(QMainWindow):
             with open(config_path, "w") as f:
                 config.write(f)
             p = DEFAULTS
-        return {
-            "ratio": int(p.get("ratio", 3)),
-            "width": int(p.get("width", 600)),
-            "height": int(p.get("height", 400)),
-            "x": int(p.get("x", 999)),
-            "y": int(p.get("y", 999)),
-            "bg_color": p.get("bg_color", "#dd6"),
-            "control_bg": p.get("control_bg", "#000"),
-            "button_bg": p.get("button_bg", "#000"),
-            "button_fg": p.get("button_fg", "#fff"),
-            "line_color": p.get("line_color", "black"),
-            "line_width": int(p.get("line_width", 3)),
-            "workspace": int(p.get("workspace", 1)),
-            "time_res": int(p.get("time_res", 50)),
-        }
+        cfg = {key: p.get(key, default) for key, default in DEFAULTS.items()}
+        for key in INT_KEYS:
+            cfg[key] = int(cfg[key])
+        return cfg
 
     def _setup_window(self):
         self.setWindowTitle("HandNotes")
@@ -224,7 +410,7 @@ class NoteApp(QMainWindow):
         layout.setContentsMargins(1, 1, 1, 1)
         layout.setSpacing(1)
         buttons = [
-            ("Save", self.save_note), ("Clear", self._clear_note),
+            ("Save", self._do_save), ("Clear", self._clear_note),
             ("<", self._previous_note), (">", self._next_note),
             (None, None), ("Exit", self.close)
         ]
@@ -242,61 +428,109 @@ class NoteApp(QMainWindow):
         return ctrl
 
     def _initialize_notes(self):
-        pattern = os.path.join(CONFIG_DIR, "note_*.png")
-        for f in sorted(glob.glob(pattern), key=os.path.getmtime):
-            try:
-                self.notes.add(Image.open(f))
-            except Exception as e:
-                print(f"Error loading {f}: {e}")
+        # Only paths are kept; a note is decoded when navigated to.
+        for f in self._list_note_files():
+            if old := self.notes.add(f):
+                try:
+                    os.remove(old)
+                except OSError as e:
+                    print(f"Error removing {old}: {e}")
+
+    def _list_note_files(self):
+        # One scandir() pass lists and filters the notes, and the sort key
+        # is read from each entry, in place of glob() plus getmtime().
+        entries = [
+            e for e in os.scandir(CONFIG_DIR)
+            if e.name.startswith("note_") and e.name.endswith(".png")
+        ]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        return [e.path for e in entries]
 
     def _set_workspace(self):
-        if shutil.which("wmctrl"):
-            subprocess.run(
-                ["wmctrl", "-r", "HandNotes", "-t", str(self.cfg["workspace"])]
-            )
+        # Move the window as soon as the window manager lists it. Matching
+        # on our own window id, rather than the title, keeps other windows
+        # that mention "HandNotes" from being picked up.
+        self._workspace_polls += 1
+        wid = int(self.winId())
+        listing = subprocess.run(
+            ["wmctrl", "-l"], capture_output=True, text=True
+        ).stdout
+        ids = set()
+        for line in listing.splitlines():
+            try:
+                ids.add(int(line.split(None, 1)[0], 16))
+            except (IndexError, ValueError):
+                continue
+        if wid not in ids:
+            if self._workspace_polls >= WORKSPACE_POLL_LIMIT:
+                self._workspace_timer.stop()
+            return
+        self._workspace_timer.stop()
+        subprocess.Popen(
+            ["wmctrl", "-i", "-r", hex(wid), "-t", str(self.cfg["workspace"])],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
 
     def save_note(self):
-        try:
-            img = self.canvas.image.copy()
-            self.notes.add(img)
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            img.save(os.path.join(CONFIG_DIR, f"note_{ts}.png"))
-            files = sorted(
-                [f for f in os.listdir(CONFIG_DIR) if f.endswith(".png")],
-                key=lambda x: os.path.getmtime(os.path.join(CONFIG_DIR, x))
-            )
-            for old in files[:-MAX_NOTES]:
-                os.remove(os.path.join(CONFIG_DIR, old))
-        except Exception as e:
-            print(f"Error saving: {e}")
+        # Restarting the timer coalesces a burst of strokes into one write.
+        self._save_timer.start(SAVE_DELAY)
+
+    def cancel_save(self):
+        self._save_timer.stop()
+
+    def _do_save(self):
+        self._save_timer.stop()
+        img = self.canvas.to_image()
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(CONFIG_DIR, f"note_{ts}.png")
+        self._save_pool.start(SaveTask(img, path, self.note_saved))
+
+    def _on_note_saved(self, path):
+        # A second save within the same second overwrites the file.
+        if self.notes.last() == path:
+            return
+        if stale := self.notes.add(path):
+            try:
+                os.remove(stale)
+            except OSError as e:
+                print(f"Error removing {stale}: {e}")
+
+    def closeEvent(self, event):
+        self._flush_pending_save()
+        self._save_pool.waitForDone()
+        self.canvas.end_painting()
+        super().closeEvent(event)
+
+    def _flush_pending_save(self):
+        # The debounced save snapshots the canvas when it fires, so it has
+        # to run before anything replaces the canvas contents.
+        if self._save_timer.isActive():
+            self._do_save()
 
     def _clear_note(self):
-        c = self.cfg
-        self.canvas.image = Image.new(
-            "RGB", (c["width"] * c["ratio"], c["height"] * c["ratio"]),
-            c["bg_color"]
-        )
-        self.canvas.draw = ImageDraw.Draw(self.canvas.image, "RGBA")
-        self.canvas._rebuild_base_pixmap()
+        self._flush_pending_save()
+        self.canvas.clear_image()
         self.save_note()
 
     def _load_last_note(self):
-        files = glob.glob(os.path.join(CONFIG_DIR, "note_*.png"))
-        if files:
-            try:
-                self.canvas.set_image(
-                    Image.open(max(files, key=os.path.getmtime))
-                )
-            except Exception as e:
-                print(f"Error loading: {e}")
+        if path := self.notes.last():
+            self._show_note(path)
+
+    def _show_note(self, path):
+        self._flush_pending_save()
+        try:
+            with Image.open(path) as img:
+                self.canvas.set_image(img)
+        except Exception as e:
+            print(f"Error loading {path}: {e}")
 
     def _previous_note(self):
-        if img := self.notes.previous():
-            self.canvas.set_image(img.copy())
+        if path := self.notes.previous():
+            self._show_note(path)
 
     def _next_note(self):
-        if img := self.notes.next():
-            self.canvas.set_image(img.copy())
+        if path := self.notes.next():
+            self._show_note(path)
 
 
 def main():
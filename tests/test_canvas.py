@@ -0,0 +1,278 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("PIL")
+QtWidgets = pytest.importorskip("PyQt5.QtWidgets")
+
+from PIL import Image  # noqa: E402
+from PyQt5.QtCore import QEvent, QPointF, Qt  # noqa: E402
+from PyQt5.QtGui import QMouseEvent  # noqa: E402
+
+import handnotes  # noqa: E402
+
+BG = (0xdd, 0xdd, 0x66)
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+class FakeApp:
+    def save_note(self):
+        pass
+
+    def cancel_save(self):
+        pass
+
+
+@pytest.fixture
+def canvas(app):
+    cfg = {
+        k: int(v) if k in handnotes.INT_KEYS else v
+        for k, v in handnotes.DEFAULTS.items()
+    }
+    c = handnotes.Canvas(None, cfg)
+    c.parent_app = FakeApp()
+    yield c
+    c.end_painting()
+
+
+def mouse(canvas, kind, x, y, button=Qt.LeftButton):
+    buttons = Qt.NoButton if kind == QEvent.MouseButtonRelease else button
+    event = QMouseEvent(kind, QPointF(x, y), button, buttons, Qt.NoModifier)
+    {
+        QEvent.MouseButtonPress: canvas.mousePressEvent,
+        QEvent.MouseMove: canvas.mouseMoveEvent,
+        QEvent.MouseButtonRelease: canvas.mouseReleaseEvent,
+    }[kind](event)
+
+
+def screen_pixel(canvas, x, y):
+    return canvas._live_pixmap.toImage().pixelColor(x, y).getRgb()[:3]
+
+
+def test_blank_canvas_exports_background(canvas):
+    assert canvas.to_image().getpixel((0, 0)) == BG
+
+
+def test_stroke_reaches_exported_image(canvas):
+    mouse(canvas, QEvent.MouseButtonPress, 10, 50)
+    for x in range(11, 100):
+        mouse(canvas, QEvent.MouseMove, x, 50)
+    mouse(canvas, QEvent.MouseButtonRelease, 100, 50)
+    r = canvas.cfg["ratio"]
+    img = canvas.to_image()
+    assert img.getpixel((50 * r, 50 * r)) == (0, 0, 0)
+    assert img.getpixel((50 * r, 80 * r)) == BG
+    assert screen_pixel(canvas, 50, 50) != BG
+
+
+def test_overlay_draws_stroke_incrementally(canvas):
+    mouse(canvas, QEvent.MouseButtonPress, 10, 50)
+    for x in range(11, 40):
+        mouse(canvas, QEvent.MouseMove, x, 50)
+    canvas._redraw_if_dirty()
+    assert screen_pixel(canvas, 20, 50) != BG
+    assert screen_pixel(canvas, 60, 50) == BG
+    for x in range(40, 80):
+        mouse(canvas, QEvent.MouseMove, x, 50)
+    canvas._redraw_if_dirty()
+    assert screen_pixel(canvas, 20, 50) != BG
+    assert screen_pixel(canvas, 60, 50) != BG
+    drawn = canvas._live_pixmap.toImage()
+    canvas._redraw_if_dirty()
+    assert canvas._live_pixmap.toImage() == drawn
+    mouse(canvas, QEvent.MouseButtonRelease, 80, 50)
+
+
+def test_erase_reaches_exported_image(canvas):
+    mouse(canvas, QEvent.MouseButtonPress, 10, 50)
+    mouse(canvas, QEvent.MouseMove, 100, 50)
+    mouse(canvas, QEvent.MouseButtonRelease, 100, 50)
+    mouse(canvas, QEvent.MouseButtonPress, 50, 50, Qt.RightButton)
+    mouse(canvas, QEvent.MouseMove, 51, 50, Qt.RightButton)
+    mouse(canvas, QEvent.MouseButtonRelease, 51, 50, Qt.RightButton)
+    r = canvas.cfg["ratio"]
+    assert canvas.to_image().getpixel((51 * r, 50 * r)) == BG
+    assert screen_pixel(canvas, 51, 50) == BG
+
+
+def test_set_image_is_displayed_and_exported(canvas):
+    size = canvas.to_image().size
+    canvas.set_image(Image.new("RGB", size, (255, 0, 0)))
+    assert screen_pixel(canvas, 5, 5) == (255, 0, 0)
+    assert canvas.to_image().getpixel((0, 0)) == (255, 0, 0)
+
+
+@pytest.fixture
+def note_app(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(handnotes, "CONFIG_DIR", str(tmp_path))
+    monkeypatch.setattr(handnotes.shutil, "which", lambda name: None)
+    size = (600 * 3, 400 * 3)
+    notes = [("RGB", (255, 0, 0)), ("RGBA", (0, 255, 0, 255)),
+             ("RGB", (0, 0, 255))]
+    for i, (mode, color) in enumerate(notes):
+        path = tmp_path / f"note_2000010{i}_000000.png"
+        Image.new(mode, size, color).save(path)
+        os.utime(path, (1000 + i, 1000 + i))
+    window = handnotes.NoteApp()
+    yield window
+    window.close()
+
+
+def test_last_note_is_loaded_and_navigable(note_app):
+    c = note_app.canvas
+    assert screen_pixel(c, 5, 5) == (0, 0, 255)
+    note_app._previous_note()
+    assert screen_pixel(c, 5, 5) == (0, 255, 0)
+    assert c.to_image().getpixel((0, 0)) == (0, 255, 0)
+    note_app._previous_note()
+    assert screen_pixel(c, 5, 5) == (255, 0, 0)
+    note_app._next_note()
+    note_app._next_note()
+    assert screen_pixel(c, 5, 5) == (0, 0, 255)
+    assert c.to_image().getpixel((0, 0)) == (0, 0, 255)
+
+
+def test_workspace_move_targets_our_window_id(note_app, monkeypatch):
+    calls = []
+    wid = int(note_app.winId())
+
+    class Result:
+        stdout = ""
+
+    def run(args, **kwargs):
+        return Result()
+
+    monkeypatch.setattr(handnotes.subprocess, "run", run)
+    monkeypatch.setattr(
+        handnotes.subprocess, "Popen", lambda args, **kw: calls.append(args)
+    )
+    note_app._workspace_polls = 0
+    note_app._workspace_timer = handnotes.QTimer()
+    # Another window titled HandNotes must not trigger the move.
+    Result.stdout = f"{wid + 1:#010x}  0 host HandNotes\n"
+    note_app._set_workspace()
+    assert calls == []
+    Result.stdout += f"{wid:#010x}  0 host HandNotes\n"
+    note_app._set_workspace()
+    assert calls == [["wmctrl", "-i", "-r", hex(wid), "-t", "1"]]
+
+
+def test_startup_prune_survives_remove_errors(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(handnotes, "CONFIG_DIR", str(tmp_path))
+    monkeypatch.setattr(handnotes.shutil, "which", lambda name: None)
+    monkeypatch.setattr(handnotes, "MAX_NOTES", 1)
+
+    def fail(path):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(handnotes.os, "remove", fail)
+    for i in range(2):
+        path = tmp_path / f"note_2000010{i}_000000.png"
+        Image.new("RGB", (1800, 1200), BG).save(path)
+        os.utime(path, (1000 + i, 1000 + i))
+    window = handnotes.NoteApp()
+    try:
+        assert window.notes.last() == str(path)
+        assert window.notes.previous() is None
+        assert len(list(tmp_path.glob("note_*.png"))) == 2
+    finally:
+        window.close()
+
+
+def finish_saves(window, app):
+    window._save_pool.waitForDone()
+    app.processEvents()
+
+
+def test_saved_note_is_recorded_after_write(note_app, app, tmp_path):
+    before = note_app.notes.last()
+    note_app._do_save()
+    finish_saves(note_app, app)
+    path = note_app.notes.last()
+    assert path != before
+    with Image.open(path) as img:
+        assert img.getpixel((0, 0)) == (0, 0, 255)
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_failed_write_leaves_no_trace(note_app, app, tmp_path, monkeypatch):
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(handnotes.os, "replace", fail)
+    before = note_app.notes.last()
+    note_app._do_save()
+    finish_saves(note_app, app)
+    assert note_app.notes.last() == before
+    assert not list(tmp_path.glob("*.part"))
+
+
+def draw_stroke(canvas, y=50):
+    mouse(canvas, QEvent.MouseButtonPress, 10, y)
+    for x in range(11, 100):
+        mouse(canvas, QEvent.MouseMove, x, y)
+    mouse(canvas, QEvent.MouseButtonRelease, 100, y)
+
+
+def saved_notes(tmp_path):
+    return sorted(
+        (p for p in tmp_path.glob("note_*.png")
+         if not p.name.startswith("note_2000010")),
+        key=os.path.getmtime
+    )
+
+
+def test_navigating_before_debounce_saves_the_stroke(note_app, app, tmp_path):
+    draw_stroke(note_app.canvas)
+    assert note_app._save_timer.isActive()
+    note_app._previous_note()
+    finish_saves(note_app, app)
+    [path] = saved_notes(tmp_path)
+    r = note_app.cfg["ratio"]
+    with Image.open(path) as img:
+        assert img.getpixel((50 * r, 50 * r)) == (0, 0, 0)
+        assert img.getpixel((0, 0)) == (0, 0, 255)
+    assert screen_pixel(note_app.canvas, 5, 5) == (0, 255, 0)
+
+
+def test_clearing_before_debounce_saves_the_stroke(note_app, app, tmp_path):
+    draw_stroke(note_app.canvas)
+    note_app._clear_note()
+    note_app._save_pool.waitForDone()
+    [path] = saved_notes(tmp_path)
+    r = note_app.cfg["ratio"]
+    with Image.open(path) as img:
+        assert img.getpixel((50 * r, 50 * r)) == (0, 0, 0)
+    assert note_app.canvas.to_image().getpixel((50 * r, 50 * r)) == BG
+
+
+def test_save_note_only_starts_the_debounce(note_app, tmp_path):
+    note_app.save_note()
+    assert note_app._save_timer.isActive()
+    note_app._save_pool.waitForDone()
+    assert saved_notes(tmp_path) == []
+
+
+def test_pressing_cancels_the_debounce(note_app):
+    note_app.save_note()
+    mouse(note_app.canvas, QEvent.MouseButtonPress, 10, 50)
+    assert not note_app._save_timer.isActive()
+    mouse(note_app.canvas, QEvent.MouseButtonRelease, 10, 50)
+    assert note_app._save_timer.isActive()
+
+
+def test_close_writes_a_pending_save(note_app, tmp_path):
+    draw_stroke(note_app.canvas)
+    note_app.close()
+    [path] = saved_notes(tmp_path)
+    r = note_app.cfg["ratio"]
+    with Image.open(path) as img:
+        assert img.getpixel((50 * r, 50 * r)) == (0, 0, 0)